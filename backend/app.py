@@ -4,12 +4,12 @@ A modern backend service for generating FFmpeg commands using Groq's Llama model
 Get your API key from: https://console.groq.com/keys
 """
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, BinaryIO, Callable, List, Optional
 import os
 import subprocess
 import tempfile
@@ -17,16 +17,28 @@ import shutil
 from pathlib import Path
 import json
 from dotenv import load_dotenv
-from PIL import Image
-from moviepy.editor import VideoFileClip, AudioFileClip
 import asyncio
 import uuid
 import traceback
 import logging
 import shlex
+import struct
+import threading
+import itertools
+import hashlib
+import functools
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import time
 import re
-from openai import OpenAI
+import random
+from urllib.parse import unquote
+import aiofiles
+
+# openai and PIL are imported on first use so startup (and /health) doesn't pay for them
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -37,7 +49,13 @@ load_dotenv()
 
 # Configure Groq API (FREE tier with generous limits)
 # Get your API key from: https://console.groq.com/keys
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Set GROQ_API_KEYS (comma-separated) to rotate several keys, each with its own quota
+GROQ_API_KEYS = [
+    key.strip()
+    for key in os.getenv("GROQ_API_KEYS", os.getenv("GROQ_API_KEY", "")).split(",")
+    if key.strip()
+]
+GROQ_API_KEY = GROQ_API_KEYS[0] if GROQ_API_KEYS else None
 if not GROQ_API_KEY:
     raise ValueError(
         "GROQ_API_KEY not found in environment variables.\n"
@@ -48,16 +66,127 @@ if not GROQ_API_KEY:
 # Using Llama 3.3 70B - fastest and most capable free model
 GROQ_MODEL = "llama-3.3-70b-versatile"
 
-client = OpenAI(
-    base_url="https://api.groq.com/openai/v1",
-    api_key=GROQ_API_KEY,
-)
+# Request parameters shared by every completion; sampling is passed per call
+GROQ_COMPLETION_PARAMS = {
+    "model": GROQ_MODEL,
+    # A command plus a short analysis is well under 1KB; the cap trims runaway generations
+    "max_tokens": 512,
+    # End generation right after the command block instead of on trailing explanation
+    "stop": ["```\n\n"],
+    # Per-request timeout so a hung call can't hold a Groq slot indefinitely
+    "timeout": float(os.getenv("GROQ_TIMEOUT", "30")),
+}
+
+
+class AsyncRateLimiter:
+    """Async context manager that spaces entries evenly to stay under a per-minute rate"""
+
+    def __init__(self, rate_per_min: int):
+        self._interval = 60.0 / rate_per_min
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def has_capacity(self) -> bool:
+        """Check whether an entry right now would proceed without waiting"""
+        return time.monotonic() >= self._next_slot
+
+
+@functools.lru_cache(maxsize=None)
+def get_groq_http_client():
+    """HTTP/2 connection pool shared by every key's client"""
+    # One kept-alive connection multiplexes concurrent completions instead of
+    # paying a TLS handshake to api.groq.com per request
+    from openai import DefaultAsyncHttpxClient
+    import httpx
+    
+    return DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    )
+
+
+class GroqKey:
+    """A Groq API key with its own client, rate limiter and rate-limit cooldown"""
+
+    def __init__(self, api_key: str, rate_per_min: int):
+        self.api_key = api_key
+        self.limiter = AsyncRateLimiter(rate_per_min=rate_per_min)
+        self.cooldown_until = 0.0
+
+    @functools.cached_property
+    def client(self) -> "AsyncOpenAI":
+        """Client for this key, created on the first request that needs it"""
+        from openai import AsyncOpenAI
+        
+        # SDK-level retries are disabled; create_completion applies its own backoff policy
+        return AsyncOpenAI(
+            base_url="https://api.groq.com/openai/v1",
+            api_key=self.api_key,
+            max_retries=0,
+            http_client=get_groq_http_client(),
+        )
+
+    def is_available(self) -> bool:
+        """Check whether the key is neither cooling down nor at its rate limit"""
+        return time.monotonic() >= self.cooldown_until and self.limiter.has_capacity()
+
+
+# Throttle Groq calls: cap in-flight requests, and enforce a per-key minimum interval between them
+GROQ_SEMAPHORE = asyncio.Semaphore(int(os.getenv("GROQ_CONCURRENCY", "2")))
+GROQ_KEYS = [GroqKey(key, rate_per_min=int(os.getenv("GROQ_RPM", "30"))) for key in GROQ_API_KEYS]
+_groq_key_cycle = itertools.cycle(GROQ_KEYS)
+
+
+def next_groq_key() -> GroqKey:
+    """Round-robin to the next available key, falling back to the next key in turn"""
+    for _ in range(len(GROQ_KEYS)):
+        key = next(_groq_key_cycle)
+        if key.is_available():
+            return key
+    return next(_groq_key_cycle)
+
+# Exponential backoff for transient Groq errors (429 / 5xx / connection failures)
+GROQ_MAX_ATTEMPTS = 5
+
+# First attempts request this many independent commands so a fallback is ready
+# without another round trip (Groq's API only supports n=1 per request). The extra
+# requests only pay off on other keys: one key would delay them behind its rate limit
+FIRST_ATTEMPT_CANDIDATES = max(1, int(os.getenv("GROQ_CANDIDATES", "2" if len(GROQ_API_KEYS) > 1 else "1")))
+CANDIDATE_TEMPERATURE = 0.7
+GROQ_RETRY_BASE_DELAY = 1.0  # seconds
+GROQ_RETRY_MAX_DELAY = 30.0  # seconds
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run one-time startup work before serving requests, and the session janitor while serving"""
+    encoder, _ = await asyncio.to_thread(detect_h264_encoder)
+    logger.info("Using H.264 encoder: %s", encoder)
+    janitor = asyncio.create_task(periodic_cleanup(SESSION_TTL, SESSION_SWEEP_INTERVAL))
+    try:
+        yield
+    finally:
+        janitor.cancel()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="FFmpeg AI Composer",
     description="Generate FFmpeg commands using natural language with Gemini AI",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
@@ -71,32 +200,64 @@ app.add_middleware(
 )
 
 # Configuration
-ALLOWED_EXTENSIONS = [
+ALLOWED_EXTENSIONS = frozenset([
     ".png", ".jpg", ".jpeg", ".webp", ".tiff", ".bmp", ".gif", ".svg",
     ".mp3", ".wav", ".ogg",
     ".mp4", ".avi", ".mov", ".mkv", ".flv", ".wmv", ".webm", ".mpg", ".mpeg", ".m4v"
-]
+])
+VIDEO_EXTENSIONS = frozenset([".mp4", ".avi", ".mkv", ".mov", ".webm", ".flv", ".wmv"])
+AUDIO_EXTENSIONS = frozenset([".mp3", ".wav", ".ogg"])
+IMAGE_EXTENSIONS = frozenset([".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif", ".webp"])
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+INGEST_CONCURRENCY = 8  # Max files saved/probed at once per request
+COMMAND_CACHE_SIZE = 256  # Max generated commands remembered per process
+FFMPEG_STDERR_TAIL_LINES = 200  # FFmpeg log lines kept for error reporting
+# FFmpeg encodes are CPU-bound and already multi-threaded, so cap concurrent runs
+# at half the cores; probes are short and mostly wait on I/O, so they get a pool
+FFMPEG_SEMAPHORE = asyncio.Semaphore(max(1, (os.cpu_count() or 2) // 2))
+PROBE_POOL = ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY, thread_name_prefix="ffprobe")
+PROGRESS_POLL_INTERVAL = 0.5  # seconds between progress event checks
+PROGRESS_RETENTION = 60  # seconds a finished session's progress stays readable
+PROGRESS_WAIT_TIMEOUT = 120  # seconds to wait for an unknown session to start rendering
 MAX_VIDEO_DURATION = 120  # 2 minutes
 
 # Working directory for temporary files
 WORK_DIR = Path(tempfile.gettempdir()) / "ffmpeg_composer"
 WORK_DIR.mkdir(exist_ok=True)
 
+# Content-addressed cache of rendered videos, kept outside WORK_DIR session dirs
+CACHE_DIR = Path(tempfile.gettempdir()) / "ffmpeg_composer_cache"
+CACHE_DIR.mkdir(exist_ok=True)
+OUTPUT_CACHE_MAX_FILES = 100
+# Generated commands persisted across restarts
+COMMAND_CACHE_DIR = CACHE_DIR / "commands"
+COMMAND_CACHE_DIR.mkdir(exist_ok=True)
+COMMAND_CACHE_MAX_FILES = 1000
+
+# Session directories older than this are removed by the periodic sweep
+SESSION_TTL = int(os.getenv("SESSION_TTL_MINUTES", "60")) * 60  # seconds
+SESSION_SWEEP_INTERVAL = 10 * 60  # seconds between sweeps
+
 # Path to bundled FFmpeg executable
 BASE_DIR = Path(__file__).parent.parent  # Project root
 FRONTEND_DIST_DIR = BASE_DIR / "frontend" / "dist"
 FRONTEND_ASSETS_DIR = FRONTEND_DIST_DIR / "assets"
 FFMPEG_BIN = BASE_DIR / "ffmpeg-8.0.1-essentials_build" / "bin" / "ffmpeg.exe"
 FFPROBE_BIN = BASE_DIR / "ffmpeg-8.0.1-essentials_build" / "bin" / "ffprobe.exe"
+# Resolved once at startup; fall back to the system binaries if the bundled build isn't there
+_FFMPEG_PATH = str(FFMPEG_BIN) if FFMPEG_BIN.exists() else "ffmpeg"
+_FFPROBE_PATH = str(FFPROBE_BIN) if FFPROBE_BIN.exists() else "ffprobe"
 
 
 def get_ffmpeg_path() -> str:
     """Get path to bundled FFmpeg executable"""
-    if FFMPEG_BIN.exists():
-        return str(FFMPEG_BIN)
-    # Fallback to system FFmpeg if bundled version not found
-    return "ffmpeg"
+    return _FFMPEG_PATH
+
+
+def get_ffprobe_path() -> str:
+    """Get path to bundled FFprobe executable"""
+    return _FFPROBE_PATH
 
 
 class FileInfo(BaseModel):
@@ -107,6 +268,8 @@ class FileInfo(BaseModel):
     dimensions: Optional[str] = None
     duration: Optional[float] = None
     audio_channels: Optional[int] = None
+    # Content digest for the output cache; internal, so never serialized into responses
+    sha256: Optional[str] = Field(default=None, exclude=True)
 
 
 class ProcessRequest(BaseModel):
@@ -116,8 +279,9 @@ class ProcessRequest(BaseModel):
     top_p: float = 0.95
 
 
+@functools.lru_cache(maxsize=None)
 def check_ffmpeg_installed():
-    """Check if FFmpeg is available"""
+    """Check if FFmpeg is available (once; it doesn't change while the server runs)"""
     try:
         ffmpeg_path = get_ffmpeg_path()
         result = subprocess.run(
@@ -131,159 +295,735 @@ def check_ffmpeg_installed():
         return False
 
 
+# Hardware H.264 encoders in order of preference, with their speed flags.
+# VAAPI is left out: it needs hwupload filters the generated commands won't include.
+H264_ENCODER_PREFERENCE = [
+    ("h264_nvenc", "-preset p1"),
+    ("h264_videotoolbox", ""),
+    ("h264_qsv", "-preset veryfast"),
+]
+LIBX264_FLAGS = "-preset veryfast -threads 0"
+
+
+@functools.lru_cache(maxsize=None)
+def detect_h264_encoder() -> tuple[str, str]:
+    """Pick the fastest working H.264 encoder, returning (encoder, extra flags)"""
+    ffmpeg_path = get_ffmpeg_path()
+    try:
+        result = subprocess.run(
+            [ffmpeg_path, "-hide_banner", "-encoders"],
+            capture_output=True,
+            text=True,
+            check=False
+        )
+        for encoder, flags in H264_ENCODER_PREFERENCE:
+            if not re.search(rf"\b{encoder}\b", result.stdout):
+                continue
+            # Encoders are listed even without the hardware, so confirm with a tiny test encode
+            test = subprocess.run(
+                [
+                    ffmpeg_path, "-hide_banner", "-v", "error",
+                    "-f", "lavfi", "-i", "color=s=256x256:d=0.1",
+                    "-c:v", encoder, "-pix_fmt", "yuv420p", "-f", "null", "-"
+                ],
+                capture_output=True,
+                check=False,
+                timeout=15
+            )
+            if test.returncode == 0:
+                return encoder, flags
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        pass
+    return "libx264", LIBX264_FLAGS
+
+
+def get_h264_encoder_args() -> str:
+    """Get the video codec arguments for the detected H.264 encoder"""
+    encoder, flags = detect_h264_encoder()
+    return f"-c:v {encoder} {flags}".strip()
+
+
+# Anything outside word characters and dots is stripped from filenames
+SANITIZE_FILENAME_RE = re.compile(r'[^\w\d_.]')
+
+
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename by replacing spaces, hyphens, and removing non-ASCII (including emoji)"""
     # Replace spaces and hyphens with underscores
     name = filename.replace(" ", "_").replace("-", "_")
     # Remove non-ASCII characters (including emoji)
-    name = re.sub(r'[^\w\d_.]', '', name)
+    name = SANITIZE_FILENAME_RE.sub('', name)
     return name
 
 
+def sweep_stale_sessions(max_age: float) -> int:
+    """Remove session directories in WORK_DIR not modified for max_age seconds"""
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in WORK_DIR.iterdir():
+        try:
+            if path.is_dir() and path.stat().st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+async def periodic_cleanup(max_age: float, interval: float) -> None:
+    """Sweep stale sessions at startup and every interval seconds, e.g. ones left by a crash"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(sweep_stale_sessions, max_age)
+            if removed:
+                logger.info("Removed %s stale session directories", removed)
+        except Exception as e:
+            logger.warning("Session sweep failed: %s", e)
+        await asyncio.sleep(interval)
+
+
+def validate_file_extension(filename: str) -> None:
+    """Reject files whose extension is not in ALLOWED_EXTENSIONS"""
+    file_ext = Path(filename or "").suffix.lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=415,
+            detail=f"File type {file_ext} not allowed"
+        )
+
+
+def validated_upload_files(files: List[UploadFile] = File(...)) -> List[UploadFile]:
+    """Dependency that validates upload extensions before any file content is read"""
+    for upload_file in files:
+        validate_file_extension(upload_file.filename)
+    return files
+
+
+def check_upload_size(size: int, filename: str) -> None:
+    """Reject an upload with 413 once it grows beyond MAX_FILE_SIZE"""
+    if size > MAX_FILE_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File {filename} exceeds maximum size of {MAX_FILE_SIZE // (1024 * 1024)}MB"
+        )
+
+
+async def write_chunks(chunks: AsyncIterator[bytes], file_path: Path, filename: str) -> str:
+    """Write streamed chunks to disk, enforcing MAX_FILE_SIZE, and return their SHA-256"""
+    size = 0
+    digest = hashlib.sha256()
+    async with aiofiles.open(file_path, "wb") as out:
+        async for chunk in chunks:
+            size += len(chunk)
+            check_upload_size(size, filename)
+            digest.update(chunk)
+            await out.write(chunk)
+    return digest.hexdigest()
+
+
+async def await_worker(future: asyncio.Future, on_cancel: Optional[Callable[[], None]] = None):
+    """Await a worker-thread future; if cancelled, let the thread finish before re-raising"""
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # A running thread can't be interrupted: ask it to stop and wait, so callers
+        # don't remove files it still has open
+        if on_cancel:
+            on_cancel()
+        await asyncio.wait([future])
+        raise
+
+
+def copy_upload_file_sync(
+    source: BinaryIO,
+    file_path: Path,
+    filename: str,
+    cancelled: threading.Event
+) -> Optional[str]:
+    """Copy a spooled upload to disk in chunks, enforcing MAX_FILE_SIZE, and return its SHA-256
+    
+    Returns None without finishing if cancelled is set between chunks.
+    """
+    size = 0
+    digest = hashlib.sha256()
+    with open(file_path, "wb") as out:
+        while chunk := source.read(UPLOAD_CHUNK_SIZE):
+            if cancelled.is_set():
+                return None
+            size += len(chunk)
+            check_upload_size(size, filename)
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+
+async def save_upload_file(upload_file: UploadFile, file_path: Path) -> str:
+    """Copy an uploaded file to disk on a worker thread, returning its SHA-256"""
+    # One thread hop for the whole copy instead of one per chunk for each read and write;
+    # on cancellation the thread stops at the next chunk and closes the file before we return
+    cancelled = threading.Event()
+    return await await_worker(
+        asyncio.ensure_future(asyncio.to_thread(
+            copy_upload_file_sync, upload_file.file, file_path, upload_file.filename, cancelled
+        )),
+        on_cancel=cancelled.set
+    )
+
+
+def probe_media(file_path: Path) -> dict:
+    """Read stream and format metadata with a single ffprobe call"""
+    result = subprocess.run(
+        [
+            get_ffprobe_path(), "-v", "error",
+            "-print_format", "json",
+            # Only emit the fields get_file_info reads
+            "-show_entries", "stream=codec_type,width,height,channels:format=duration",
+            str(file_path)
+        ],
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    data = json.loads(result.stdout)
+    duration = data.get("format", {}).get("duration")
+    return {
+        "streams": data.get("streams", []),
+        "duration": float(duration) if duration is not None else None
+    }
+
+
+# JPEG start-of-frame markers (C4, C8 and CC share the range but aren't frames)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def read_jpeg_dimensions(f: BinaryIO) -> Optional[tuple[int, int]]:
+    """Walk JPEG segments, seeking past each, until a start-of-frame header"""
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # Fill bytes may pad a marker
+            marker = f.read(1)
+        if not marker:
+            return None
+        if marker[0] == 0x01 or 0xD0 <= marker[0] <= 0xD9:  # Standalone markers have no length
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length,) = struct.unpack(">H", length_bytes)
+        if marker[0] in JPEG_SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">xHH", frame)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image_dimensions(file_path: Path) -> Optional[tuple[int, int]]:
+    """Read (width, height) from PNG, GIF, BMP, WebP or JPEG headers without decoding"""
+    with open(file_path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head.startswith(b"BM") and len(head) >= 26:
+            if struct.unpack("<I", head[14:18])[0] == 12:  # OS/2 BITMAPCOREHEADER
+                return struct.unpack("<HH", head[18:22])
+            width, height = struct.unpack("<ii", head[18:26])
+            return width, abs(height)  # Negative height marks a top-down bitmap
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                (bits,) = struct.unpack("<I", head[21:25])
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return (
+                    int.from_bytes(head[24:27], "little") + 1,
+                    int.from_bytes(head[27:30], "little") + 1,
+                )
+        if head.startswith(b"\xff\xd8"):
+            return read_jpeg_dimensions(f)
+    return None
+
+
 def get_file_info(file_path: Path) -> FileInfo:
-    """Extract metadata from media file"""
+    """Extract metadata from media file (saved under an already sanitized name)"""
     info = FileInfo(
-        name=sanitize_filename(file_path.name),
+        name=file_path.name,
         type="unknown",
         size=file_path.stat().st_size
     )
     
     file_extension = file_path.suffix.lower()
     
-    if file_extension in [".mp4", ".avi", ".mkv", ".mov", ".webm", ".flv", ".wmv"]:
+    if file_extension in VIDEO_EXTENSIONS:
         info.type = "video"
         try:
-            video = VideoFileClip(str(file_path))
-            info.duration = video.duration
-            info.dimensions = f"{video.size[0]}x{video.size[1]}"
-            if video.audio:
+            probe = probe_media(file_path)
+            video_stream = next((st for st in probe["streams"] if st.get("codec_type") == "video"), None)
+            audio_stream = next((st for st in probe["streams"] if st.get("codec_type") == "audio"), None)
+            info.duration = probe["duration"]
+            if video_stream:
+                info.dimensions = f"{video_stream['width']}x{video_stream['height']}"
+            if audio_stream:
                 info.type = "video/audio"
-                info.audio_channels = video.audio.nchannels
-            video.close()
+                info.audio_channels = audio_stream.get("channels")
         except Exception as e:
             print(f"Error reading video: {e}")
             
-    elif file_extension in [".mp3", ".wav", ".ogg"]:
+    elif file_extension in AUDIO_EXTENSIONS:
         info.type = "audio"
         try:
-            audio = AudioFileClip(str(file_path))
-            info.duration = audio.duration
-            info.audio_channels = audio.nchannels
-            audio.close()
+            probe = probe_media(file_path)
+            audio_stream = next((st for st in probe["streams"] if st.get("codec_type") == "audio"), None)
+            info.duration = probe["duration"]
+            if audio_stream:
+                info.audio_channels = audio_stream.get("channels")
         except Exception as e:
             print(f"Error reading audio: {e}")
             
-    elif file_extension in [".png", ".jpg", ".jpeg", ".tiff", ".bmp", ".gif", ".webp"]:
+    elif file_extension in IMAGE_EXTENSIONS:
         info.type = "image"
         try:
-            img = Image.open(file_path)
-            info.dimensions = f"{img.size[0]}x{img.size[1]}"
+            size = read_image_dimensions(file_path)
+            if size is None:
+                # Other formats (e.g. TIFF): Image.open only parses the header, never pixel data
+                from PIL import Image
+                
+                with Image.open(file_path) as img:
+                    size = img.size
+            info.dimensions = f"{size[0]}x{size[1]}"
         except Exception as e:
             print(f"Error reading image: {e}")
     
     return info
 
 
+def unique_sanitized_filenames(filenames: List[str]) -> List[str]:
+    """Sanitize filenames, suffixing repeats (e.g. "a b.png" and "a-b.png") so each gets its own file"""
+    used = set()
+    names = []
+    for filename in filenames:
+        name = sanitize_filename(filename)
+        stem, suffix = os.path.splitext(name)
+        count = 0
+        # Compare case-insensitively, as Windows paths are
+        while name.lower() in used:
+            count += 1
+            name = f"{stem}_{count}{suffix}"
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+async def ingest_upload_files(files: List[UploadFile], session_dir: Path) -> List[FileInfo]:
+    """Save and analyze uploaded files concurrently, preserving upload order"""
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    
+    async def _ingest(upload_file: UploadFile, sanitized_name: str) -> FileInfo:
+        file_path = session_dir / sanitized_name
+        
+        # Only the save holds a slot: the next upload streams to disk while this
+        # file is probed (PROBE_POOL bounds concurrent probes on its own)
+        async with semaphore:
+            logger.info("Saving file: %s", sanitized_name)
+            sha256 = await save_upload_file(upload_file, file_path)
+        
+        logger.info("Analyzing file: %s", sanitized_name)
+        file_info = await await_worker(
+            asyncio.get_running_loop().run_in_executor(PROBE_POOL, get_file_info, file_path)
+        )
+        file_info.sha256 = sha256
+        logger.info("File info: %s", file_info)
+        return file_info
+    
+    names = unique_sanitized_filenames([f.filename for f in files])
+    tasks = [asyncio.create_task(_ingest(f, name)) for f, name in zip(files, names)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        # Stop sibling saves and probes, and wait for their threads, before the
+        # caller removes the session directory
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 def create_files_info_table(files_info: List[FileInfo]) -> str:
     """Create a markdown table of file information"""
-    table = "| Type | Name | Dimensions | Duration | Audio Channels |\n"
-    table += "|------|------|------------|----------|----------------|\n"
-    
-    for info in files_info:
-        dimensions = info.dimensions or "-"
-        duration = f"{info.duration}s" if info.duration else "-"
-        audio = f"{info.audio_channels} channels" if info.audio_channels else "-"
-        table += f"| {info.type} | {info.name} | {dimensions} | {duration} | {audio} |\n"
+    rows = [
+        "| Type | Name | Dimensions | Duration | Audio Channels |",
+        "|------|------|------------|----------|----------------|",
+    ]
+    rows.extend(
+        f"| {info.type} | {info.name} | {info.dimensions or '-'} "
+        f"| {f'{info.duration}s' if info.duration else '-'} "
+        f"| {f'{info.audio_channels} channels' if info.audio_channels else '-'} |"
+        for info in files_info
+    )
+    return "\n".join(rows) + "\n"
+
+
+def is_retryable_api_error(error: Exception) -> bool:
+    """Check whether an AI API error is transient and worth retrying"""
+    from openai import APIConnectionError, APIStatusError, RateLimitError
     
-    return table
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    if isinstance(error, APIStatusError) and error.status_code >= 500:
+        return True
+    message = str(error).lower()
+    return "rate limit" in message or "quota" in message
+
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    """Compute backoff delay, honoring the server's Retry-After header when present"""
+    backoff = random.uniform(0, min(GROQ_RETRY_MAX_DELAY, GROQ_RETRY_BASE_DELAY * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        server_delay = float(retry_after) if retry_after else 0.0
+    except ValueError:
+        server_delay = 0.0
+    return min(GROQ_RETRY_MAX_DELAY, max(backoff, server_delay))
 
 
-async def generate_ffmpeg_command(
-    prompt: str,
-    files_info: List[FileInfo],
-    temperature: float = 0.1,
-    top_p: float = 0.95,
-    previous_error: Optional[str] = None,
-    previous_command: Optional[str] = None
-) -> tuple[str, str]:
-    """Generate FFmpeg command using OpenAI-compatible API"""
+# Fenced code blocks (```bash, ```sh, ```shell or plain ```) in group 1,
+# or inline `...` code spans containing ffmpeg in group 2, matched in one pass
+COMMAND_BLOCK_RE = re.compile(
+    r"```(?:bash|shell|sh)?\s*\n?(.*?)```|`([^`]*ffmpeg[^`]*)`",
+    re.DOTALL | re.IGNORECASE
+)
+
+# A closed code block containing an ffmpeg command; once seen, the rest of the stream is discarded
+COMPLETE_COMMAND_BLOCK_RE = re.compile(r"```[^\n]*\n.*?ffmpeg.*?```", re.DOTALL | re.IGNORECASE)
+
+
+async def read_completion_stream(client: "AsyncOpenAI", **params) -> str:
+    """Stream a chat completion, stopping as soon as a complete command block arrives"""
+    stream = await client.chat.completions.create(stream=True, **params)
+    text = ""
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            text += delta
+            if "`" in delta and COMPLETE_COMMAND_BLOCK_RE.search(text):
+                logger.info("Command block complete, closing AI stream early")
+                break
+    finally:
+        await stream.close()
+    # The API drops the matched stop sequence, which takes the closing fence with it
+    if text.count("```") % 2:
+        text += "```"
+    return text
+
+
+async def create_completion(messages: List[dict], temperature: float, top_p: float) -> str:
+    """Call the Groq chat completion API with throttling and retries on transient errors"""
+    from openai import RateLimitError
     
-    files_table = create_files_info_table(files_info)
+    for attempt in range(GROQ_MAX_ATTEMPTS):
+        key = next_groq_key()
+        try:
+            async with GROQ_SEMAPHORE, key.limiter:
+                logger.info("Calling Groq API...")
+                return await read_completion_stream(
+                    key.client,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=top_p,
+                    **GROQ_COMPLETION_PARAMS,
+                )
+        except Exception as e:
+            if attempt == GROQ_MAX_ATTEMPTS - 1 or not is_retryable_api_error(e):
+                raise
+            delay = get_retry_delay(e, attempt)
+            if isinstance(e, RateLimitError):
+                key.cooldown_until = time.monotonic() + delay
+                if any(k.is_available() for k in GROQ_KEYS):
+                    logger.warning("Groq API key rate limited (attempt %s/%s), switching keys", attempt + 1, GROQ_MAX_ATTEMPTS)
+                    continue
+            logger.warning("Groq API error (attempt %s/%s): %s. Retrying in %.1fs", attempt + 1, GROQ_MAX_ATTEMPTS, e, delay)
+            await asyncio.sleep(delay)
+
+
+# Prompt heuristics for requests that map directly onto a canned FFmpeg command
+SLIDESHOW_PROMPT_RE = re.compile(r"slideshow|montage|photos", re.IGNORECASE)
+WAVEFORM_PROMPT_RE = re.compile(r"waveform|visuali[sz]e", re.IGNORECASE)
+VERTICAL_PROMPT_RE = re.compile(r"vertical|portrait|9:16|tiktok|stories|phone", re.IGNORECASE)
+SQUARE_PROMPT_RE = re.compile(r"square|1:1|instagram post", re.IGNORECASE)
+PROMPT_WORD_RE = re.compile(r"[a-z0-9:]+")
+# Templates only serve prompts made entirely of these words; any other requirement
+# (grayscale, watermark, GIF, timing...) goes to the AI rather than being dropped
+TEMPLATE_PROMPT_WORDS = frozenset("""
+    slideshow montage photos photo images image pictures picture pics
+    waveform visualize visualise visualization visualisation audio song track sound
+    vertical portrait 9:16 tiktok instagram stories story phone
+    horizontal landscape 16:9 youtube square 1:1 post
+    a an the of from with for to into as in on and using these this my our all them it me
+    make create generate build turn show please simple basic quick video clip
+""".split())
+
+# In-memory LRU in front of COMMAND_CACHE_DIR, keyed on a hash of (prompt, files, sampling settings)
+_command_cache: "OrderedDict[str, tuple[str, str]]" = OrderedDict()
+
+
+def try_template_command(prompt: str, files_info: List[FileInfo]) -> Optional[tuple[str, str]]:
+    """Build a canned slideshow/waveform command for trivial requests, or None on miss"""
+    if not files_info or not TEMPLATE_PROMPT_WORDS.issuperset(PROMPT_WORD_RE.findall(prompt.lower())):
+        return None
+    
+    vertical, square = VERTICAL_PROMPT_RE.search(prompt), SQUARE_PROMPT_RE.search(prompt)
+    if vertical and square:
+        return None  # Conflicting formats: leave the choice to the AI
+    if vertical:
+        width, height = 1080, 1920
+    elif square:
+        width, height = 1080, 1080
+    else:
+        width, height = 1920, 1080
+    images = [info for info in files_info if info.type == "image"]
+    audios = [info for info in files_info if info.type == "audio"]
     
-    system_prompt = """You are an expert FFmpeg engineer. Generate precise, working FFmpeg commands.
+    if len(images) == len(files_info) and SLIDESHOW_PROMPT_RE.search(prompt):
+        inputs = " ".join(f"-loop 1 -t 3 -i {info.name}" for info in images)
+        scaled = ";".join(
+            f"[{i}]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1[v{i}]"
+            for i in range(len(images))
+        )
+        labels = "".join(f"[v{i}]" for i in range(len(images)))
+        command = (
+            f'ffmpeg {inputs} -filter_complex "{scaled};{labels}concat=n={len(images)}:v=1:a=0" '
+            f"{get_h264_encoder_args()} -pix_fmt yuv420p -movflags +faststart output.mp4"
+        )
+        analysis = f"Slideshow of {len(images)} image(s) at {width}x{height}, 3 seconds each."
+        
+    elif len(audios) == 1 and len(files_info) - len(images) == 1 and len(images) <= 1 \
+            and WAVEFORM_PROMPT_RE.search(prompt):
+        audio = audios[0]
+        if images:
+            command = (
+                f'ffmpeg -i {audio.name} -loop 1 -i {images[0].name} -filter_complex '
+                f'"[0:a]showwaves=s={width}x200:mode=line:colors=white[wave];'
+                f'[1]scale={width}:{height}[bg];[bg][wave]overlay=0:(H-h)/2" '
+                f"{get_h264_encoder_args()} -pix_fmt yuv420p -c:a aac -shortest -movflags +faststart output.mp4"
+            )
+        else:
+            command = (
+                f'ffmpeg -i {audio.name} -filter_complex '
+                f'"[0:a]showwaves=s={width}x{height}:mode=line:colors=white,format=yuv420p[v]" '
+                f'-map "[v]" -map 0:a {get_h264_encoder_args()} -pix_fmt yuv420p -c:a aac -shortest -movflags +faststart output.mp4'
+            )
+        analysis = f"Full-width audio waveform visualization at {width}x{height}."
+        
+    else:
+        return None
+    
+    return command, f"{analysis}\n\n```bash\n{command}\n```"
+
+
+def get_command_cache_key(prompt: str, files_info: List[FileInfo], temperature: float, top_p: float) -> str:
+    """Hash a generation request's prompt, file metadata and sampling settings"""
+    # Kept in upload order: the generated -i order follows it
+    files_key = [
+        (info.name, info.type, info.size, info.dimensions, info.duration, info.audio_channels)
+        for info in files_info
+    ]
+    payload = json.dumps([prompt, files_key, temperature, top_p])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def remember_command(cache_key: str, entry: tuple[str, str]) -> None:
+    """Insert an entry into the in-memory command LRU"""
+    _command_cache[cache_key] = entry
+    _command_cache.move_to_end(cache_key)
+    if len(_command_cache) > COMMAND_CACHE_SIZE:
+        _command_cache.popitem(last=False)
+
+
+def load_cached_command(cache_key: str) -> Optional[tuple[str, str]]:
+    """Look up a generated command in memory, then on disk"""
+    cached = _command_cache.get(cache_key)
+    if cached:
+        _command_cache.move_to_end(cache_key)
+        return cached
+    try:
+        data = json.loads((COMMAND_CACHE_DIR / f"{cache_key}.json").read_text())
+        cached = (data["command"], data["full_response"])
+    except (OSError, ValueError, KeyError):
+        return None
+    remember_command(cache_key, cached)
+    return cached
+
+
+def store_cached_command(cache_key: str, command: str, full_response: str) -> None:
+    """Persist a generated command, evicting the oldest files beyond the limit"""
+    try:
+        tmp_file = COMMAND_CACHE_DIR / f"{cache_key}.{uuid.uuid4().hex}.tmp"
+        tmp_file.write_text(json.dumps({"command": command, "full_response": full_response}))
+        os.replace(tmp_file, COMMAND_CACHE_DIR / f"{cache_key}.json")
+        
+        cached_files = sorted(COMMAND_CACHE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime)
+        for cached_file in cached_files[:-COMMAND_CACHE_MAX_FILES]:
+            cached_file.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning("Failed to cache command: %s", e)
+
+
+# Static instructions sent as the system message; encoder placeholders are filled by get_system_prompt
+SYSTEM_PROMPT_TEMPLATE = """You are an expert FFmpeg engineer. Generate precise, working FFmpeg commands.
 
 ## OUTPUT FORMAT
-1. Brief analysis (2-3 sentences max)
+1. Brief analysis, 2-3 sentences max
 2. Single FFmpeg command in a ```bash code block
 3. Output file must be "output.mp4"
 
 ## CORE RULES
-- ONE command only, no chaining (no && or ;)
-- Use exact filenames from the asset list
-- Keep commands as simple as possible
-- Always use: -c:v libx264 -pix_fmt yuv420p -movflags +faststart
-
-## SLIDESHOW PATTERN (for multiple images)
-When combining images with different dimensions:
+- ONE command only, no chaining: no && or ;
+- Use exact filenames from asset list
+- Keep commands simple
+- Always use: {H264_ENCODER_ARGS} -pix_fmt yuv420p -movflags +faststart
+- Default 1920x1080; vertical/portrait/TikTok 1080x1920; square 1080x1080
+- Normalize every visual input with scale+pad: [i]scale=W:H:force_original_aspect_ratio=decrease,pad=W:H:(ow-iw)/2:(oh-ih)/2,setsar=1[vi]
+
+## SLIDESHOW
+3 seconds per image by default:
 ```bash
-ffmpeg -loop 1 -t 3 -i img1.jpg -loop 1 -t 3 -i img2.jpg -filter_complex "[0]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][v1]concat=n=2:v=1:a=0" -c:v libx264 -pix_fmt yuv420p output.mp4
+ffmpeg -loop 1 -t 3 -i img1.jpg -loop 1 -t 3 -i img2.jpg -filter_complex "[0]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][v1]concat=n=2:v=1:a=0" -c:v {H264_ENCODER} -pix_fmt yuv420p output.mp4
 ```
-- Default: 1920x1080, 3 seconds per image
-- Vertical/portrait/TikTok: use 1080x1920
-- Always scale+pad to normalize dimensions
 
 ## AUDIO WAVEFORM
-For full-width waveform visualization (waveform width = video width):
 ```bash
-ffmpeg -i audio.mp3 -i bg.png -filter_complex "[0:a]showwaves=s=1920x200:mode=line:colors=white[wave];[1]scale=1920:1080[bg];[bg][wave]overlay=0:(H-h)/2" -c:v libx264 -c:a aac output.mp4
+ffmpeg -i audio.mp3 -loop 1 -i bg.png -filter_complex "[0:a]showwaves=s=1920x200:mode=line:colors=white[wave];[1]scale=1920:1080[bg];[bg][wave]overlay=0:(H-h)/2" -shortest -c:v {H264_ENCODER} -c:a aac output.mp4
 ```
-CRITICAL:
-- showwaves size uses 'x' separator: s=WIDTHxHEIGHT (NOT s=WIDTH:HEIGHT)
-- For full-width: set waveform width = video width (e.g., s=1920x200 for 1920px wide video)
-- overlay=0:(H-h)/2 positions at x=0 (full width) and centers vertically
+- showwaves size uses 'x': s=WIDTHxHEIGHT, never s=WIDTH:HEIGHT
+- Full width: waveform width = video width; overlay=0:(H-h)/2 centers vertically
 
-## WITH BACKGROUND MUSIC
-Add audio to video/slideshow:
-```bash
-ffmpeg ... -i music.mp3 -map "[vout]" -map N:a -shortest -c:a aac output.mp4
-```
-Where N is the audio input index.
+## BACKGROUND MUSIC
+Add -i music.mp3 -map "[vout]" -map N:a -shortest -c:a aac, N = audio input index.
 
 ## VIDEO CONCATENATION
-When concatenating multiple videos:
-
-### All videos have audio:
-```bash
-ffmpeg -i video1.mp4 -i video2.mp4 -filter_complex "[0:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][0:a][v1][1:a]concat=n=2:v=1:a=1[vout][aout]" -map "[vout]" -map "[aout]" -c:v libx264 -c:a aac output.mp4
-```
-
-### Some videos have audio, some don't:
-Generate silent audio for videos without audio, then concat:
+All inputs have audio:
 ```bash
-ffmpeg -i video_with_audio.mp4 -i video_no_audio.mp4 -filter_complex "[0:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[1:v]anullsrc=channel_layout=stereo:sample_rate=48000[silent];[v0][0:a][v1][silent]concat=n=2:v=1:a=1[vout][aout]" -map "[vout]" -map "[aout]" -c:v libx264 -c:a aac output.mp4
+ffmpeg -i v1.mp4 -i v2.mp4 -filter_complex "[0:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][0:a][v1][1:a]concat=n=2:v=1:a=1[vout][aout]" -map "[vout]" -map "[aout]" -c:v {H264_ENCODER} -c:a aac output.mp4
 ```
+- Input without audio: silent source trimmed to its duration D, e.g. anullsrc=r=48000:cl=stereo,atrim=duration=D[s1], then [v0][0:a][v1][s1]concat=n=2:v=1:a=1[vout][aout]
+- Separate audio track, or no input audio: concat=n=2:v=1:a=0[vout], then -map "[vout]" -map N:a -shortest
+- Speed change: setpts BEFORE scale/pad, e.g. [1:v]setpts=2*PTS,scale=...[v1] for half speed; audio uses atempo, range 0.5-2.0
+
+## CONCAT RULES
+- audio_channels None in asset list = NO audio stream; never reference [i:a] for it
+- concat outputs [vout][aout] when a=1, only [vout] when a=0
+- Always -map "[vout]", plus -map "[aout]" or -map N:a"""
+
+
+@functools.lru_cache(maxsize=None)
+def get_system_prompt() -> str:
+    """Build the system prompt once, with the detected H.264 encoder filled in"""
+    encoder, _ = detect_h264_encoder()
+    return (
+        SYSTEM_PROMPT_TEMPLATE
+        .replace("{H264_ENCODER_ARGS}", get_h264_encoder_args())
+        .replace("{H264_ENCODER}", encoder)
+    )
 
-### Concatenate videos + add separate audio track:
-For videos without audio OR to replace video audio with separate audio file:
-```bash
-ffmpeg -i v1.mp4 -i v2.mp4 -i music.mp3 -filter_complex "[0:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[1:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][v1]concat=n=2:v=1:a=0[vout]" -map "[vout]" -map 2:a -shortest -c:v libx264 -c:a aac output.mp4
-```
-Use concat=n=2:v=1:a=0 (no audio) when videos don't have audio or you want to use separate audio.
 
-### Speed changes + concatenation:
-To slow down a video (0.5x = half speed = 2x duration):
-```bash
-ffmpeg -i v1.mp4 -i v2_slow.mp4 -filter_complex "[1:v]setpts=2*PTS[v1_slow];[0:v]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v0];[v1_slow]scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1[v1];[v0][v1]concat=n=2:v=1:a=0[vout]" -map "[vout]" -c:v libx264 output.mp4
-```
-IMPORTANT: Apply setpts BEFORE scale/pad. For audio: use atempo filter (range 0.5-2.0).
+def extract_ffmpeg_command(full_response: str) -> Optional[str]:
+    """Extract the FFmpeg command from an AI response"""
+    # Extract command from code block - using the robust extraction from original project
+    command = None
+    inline_command = None
+    
+    # First fenced code block that contains an ffmpeg command; inline code is
+    # only a fallback, so keep scanning past it for a fenced block
+    for match in COMMAND_BLOCK_RE.finditer(full_response):
+        fenced, inline = match.groups()
+        if fenced is not None:
+            if "ffmpeg" in fenced.lower():
+                command = fenced.strip()
+                break
+        elif inline_command is None:
+            inline_command = inline.strip()
+    
+    if not command:
+        command = inline_command
+    
+    # No code found: prefer a line starting with ffmpeg, else any line containing it
+    if not command:
+        contains_ffmpeg = None
+        for line in full_response.split("\n"):
+            line = line.strip()
+            lowered = line.lower()
+            if lowered.startswith("ffmpeg"):
+                command = line
+                break
+            if contains_ffmpeg is None and "ffmpeg" in lowered and len(line) > 10:
+                contains_ffmpeg = line
+        else:
+            command = contains_ffmpeg
+    
+    # Handle multi-line commands (remove line continuations)
+    if command:
+        logger.info("Extracted command: %.200s...", command)
+    else:
+        logger.error("Failed to extract command from AI response")
+        logger.error("Full response: %s", full_response)
+    
+    return command
 
-CRITICAL CONCAT RULES:
-- Check asset list for audio_channels. If None, video has NO audio stream
-- Create output labels: concat outputs [vout][aout] or just [vout] if a=0
-- Always use -map "[vout]" for video output from filter_complex
-- Use -map "[aout]" if concat has audio (a=1), or -map N:a for separate audio file
-- Never reference non-existent audio streams (e.g., [1:a] when video 1 has no audio)"""
 
+async def generate_ffmpeg_commands(
+    prompt: str,
+    files_info: List[FileInfo],
+    temperature: float = 0.1,
+    top_p: float = 0.95,
+    previous_error: Optional[str] = None,
+    previous_command: Optional[str] = None,
+    candidates: int = 1,
+    files_table: Optional[str] = None
+) -> AsyncIterator[tuple[Optional[str], str]]:
+    """Generate candidate FFmpeg commands using OpenAI-compatible API, best first
+    
+    Candidates are yielded as their requests complete, so the first can be run
+    while the others are still generating; closing the iterator cancels them.
+    Pass files_table (from create_files_info_table) to reuse it across retries.
+    """
+    
+    cache_key = get_command_cache_key(prompt, files_info, temperature, top_p)
+    
+    # First attempts can skip the AI call for trivial or repeated requests
+    if not previous_error:
+        template = try_template_command(prompt, files_info)
+        if template:
+            logger.info("Using templated command, skipping AI call")
+            yield template
+            return
+        
+        cached = await asyncio.to_thread(load_cached_command, cache_key)
+        if cached:
+            logger.info("Using cached command, skipping AI call")
+            yield cached
+            return
+    
+    if files_table is None:
+        files_table = create_files_info_table(files_info)
+    
     user_message = f"""## AVAILABLE ASSETS
 
 {files_table}
@@ -329,116 +1069,285 @@ FORMAT DETECTION KEYWORDS:
     
     # Build messages array
     messages = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": get_system_prompt()},
         {"role": "user", "content": user_message}
     ]
     
-    # Call Groq API
+    # Call Groq API; extra candidates are sampled hotter so they differ from the first
+    temperatures = [temperature] + [max(temperature, CANDIDATE_TEMPERATURE)] * (candidates - 1)
+    tasks = [asyncio.create_task(create_completion(messages, t, top_p)) for t in temperatures]
     try:
-        logger.info("Calling Groq API...")
-        completion = await asyncio.to_thread(
-            client.chat.completions.create,
-            model=GROQ_MODEL,
-            messages=messages,
-            temperature=temperature,
-            top_p=top_p,
-            max_tokens=2048,
-        )
-        
-        full_response = completion.choices[0].message.content
-        logger.info(f"AI response length: {len(full_response)} characters")
-        logger.info(f"AI response preview: {full_response[:500]}...")
+        first_error = None
+        yielded = []
+        for task in tasks:
+            try:
+                full_response = await task
+            except Exception as e:
+                first_error = first_error or e
+                continue
+            
+            logger.info("AI response length: %s characters", len(full_response))
+            logger.info("AI response preview: %.500s...", full_response)
+            command = extract_ffmpeg_command(full_response)
+            if command and command in yielded:
+                continue
+            yielded.append(command)
+            yield command, full_response
         
-    except Exception as e:
-        logger.error(f"Error calling AI API: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error calling AI API: {str(e)}"
-        )
-    
-    # Extract command from code block - using the robust extraction from original project
-    command = None
-    
-    # Try multiple code block patterns
-    code_patterns = [
-        r"```(?:bash|sh|shell)?\n(.*?)\n```",  # Standard code blocks
-        r"```\n(.*?)\n```",  # Plain code blocks
-        r"`([^`]*ffmpeg[^`]*)`",  # Inline code with ffmpeg
-    ]
-    
-    for pattern in code_patterns:
-        matches = re.findall(pattern, full_response, re.DOTALL | re.IGNORECASE)
-        for match in matches:
-            if "ffmpeg" in match.lower():
-                command = match.strip()
-                break
-        if command:
-            break
-    
-    # If no code block found, try to find ffmpeg lines directly
-    if not command:
-        ffmpeg_lines = [
-            line.strip()
-            for line in full_response.split("\n")
-            if line.strip().lower().startswith("ffmpeg")
-        ]
-        if ffmpeg_lines:
-            command = ffmpeg_lines[0]
-    
-    # Last resort: look for any line containing ffmpeg
-    if not command:
-        for line in full_response.split("\n"):
-            line = line.strip()
-            if "ffmpeg" in line.lower() and len(line) > 10:
-                command = line
-                break
+        if not yielded:
+            logger.error("Error calling AI API: %s", first_error)
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error calling AI API: {str(first_error)}"
+            )
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # Mark failures of unconsumed candidates as retrieved
+
+
+async def generate_ffmpeg_command(
+    prompt: str,
+    files_info: List[FileInfo],
+    temperature: float = 0.1,
+    top_p: float = 0.95,
+    previous_error: Optional[str] = None,
+    previous_command: Optional[str] = None
+) -> tuple[Optional[str], str]:
+    """Generate FFmpeg command using OpenAI-compatible API"""
+    candidates = generate_ffmpeg_commands(
+        prompt=prompt,
+        files_info=files_info,
+        temperature=temperature,
+        top_p=top_p,
+        previous_error=previous_error,
+        previous_command=previous_command
+    )
+    first = None
+    try:
+        async for command, full_response in candidates:
+            if command:
+                return command, full_response
+            first = first or (command, full_response)
+    finally:
+        await candidates.aclose()
+    return first
+
+
+# Decode acceleration requested for video inputs ("" disables it)
+FFMPEG_HWACCEL = os.getenv("FFMPEG_HWACCEL", "auto")
+
+OVERWRITE_FLAG_RE = re.compile(r"(?<!\S)-y(?!\S)")
+COMMAND_START_RE = re.compile(r"^ffmpeg(?!\S)")
+OUTPUT_FILE_RE = re.compile(r"""(?<!\S)(["']?)output\.mp4\1\s*$""")
+# The concat filter or -f concat demuxer as a whole word, not a filename containing "concat"
+CONCAT_RE = re.compile(r"""(?:^|[\s"';,\]])concat(?=[\s"';,=\[]|$)""")
+
+
+def apply_ffmpeg_command_hints(command: str, files_info: List[FileInfo]) -> str:
+    """Add decode and timestamp flags the AI doesn't reliably emit to a generated command"""
+    global_flags = [] if OVERWRITE_FLAG_RE.search(command) else ["-y"]
+    input_flags = []
+    if FFMPEG_HWACCEL and "-hwaccel" not in command:
+        input_flags += ["-hwaccel", FFMPEG_HWACCEL]
+    is_concat = bool(CONCAT_RE.search(command))
+    if is_concat and "+genpts" not in command:
+        input_flags += ["-fflags", "+genpts"]
     
-    # Handle multi-line commands (remove line continuations)
-    if command:
-        logger.info(f"Extracted command: {command[:200]}...")
-    else:
-        logger.error("Failed to extract command from AI response")
-        logger.error(f"Full response: {full_response}")
+    # Input options must precede each -i they apply to; only video inputs benefit
+    if input_flags:
+        for info in files_info:
+            if info.type.startswith("video"):
+                command = re.sub(
+                    rf"(?<!\S)-i\s+([\"']?){re.escape(info.name)}\1(?!\S)",
+                    lambda m: f"{' '.join(input_flags)} {m.group(0)}",
+                    command
+                )
     
-    return command, full_response
+    if global_flags:
+        command = COMMAND_START_RE.sub(f"ffmpeg {' '.join(global_flags)}", command)
+    if is_concat and "-avoid_negative_ts" not in command:
+        command = OUTPUT_FILE_RE.sub(r"-avoid_negative_ts make_zero \1output.mp4\1", command)
+    return command
+
+
+# Key=value lines emitted by `-progress pipe:2`
+FFMPEG_PROGRESS_RE = re.compile(
+    r"^(frame|fps|stream_\d+_\d+_q|bitrate|total_size|out_time_us|out_time_ms|out_time|"
+    r"dup_frames|drop_frames|speed|progress)=(.*)$"
+)
+
+# Latest progress state per session, readable via /progress/{session_id}
+SESSION_PROGRESS: dict = {}
+
+
+def update_progress(session_id: str, **fields) -> None:
+    """Merge fields into a session's progress state (safe to call from worker threads)"""
+    SESSION_PROGRESS[session_id] = {**SESSION_PROGRESS.get(session_id, {}), **fields}
+
+
+def finish_progress(session_id: str, status: str, **fields) -> None:
+    """Record a session's final status and forget it after PROGRESS_RETENTION seconds"""
+    update_progress(session_id, status=status, **fields)
+    asyncio.get_running_loop().call_later(PROGRESS_RETENTION, SESSION_PROGRESS.pop, session_id, None)
 
 
-def execute_ffmpeg_command_sync(command: str, work_dir: Path) -> tuple[bool, str]:
-    """Execute FFmpeg command synchronously and return success status and output"""
+def fail_unfinished_progress(session_id: str) -> None:
+    """Mark a session failed unless it already finished"""
+    if SESSION_PROGRESS.get(session_id, {}).get("status") not in ("done", "failed"):
+        finish_progress(session_id, "failed")
+
+
+def normalize_session_id(session_id: str) -> str:
+    """Canonicalize a client-supplied session UUID (e.g. uppercase) so POSTs and /progress agree"""
+    try:
+        return str(uuid.UUID(session_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Session ID must be a UUID")
+
+
+def parse_session_id(session_id: Optional[str]) -> str:
+    """Validate a client-supplied session ID, or create a new one"""
+    if not session_id:
+        return str(uuid.uuid4())
+    session_id = normalize_session_id(session_id)
+    if (WORK_DIR / session_id).exists():
+        raise HTTPException(status_code=409, detail="Session ID already in use")
+    return session_id
+
+
+@functools.lru_cache(maxsize=256)
+def tokenize_ffmpeg_command(command: str) -> tuple:
+    """Split a command into arguments (POSIX quoting), cached across retries and reruns"""
+    lexer = shlex.shlex(command, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ""  # '#' is literal, e.g. in color=#ffffff
+    return tuple(lexer)
+
+
+class FFmpegLog:
+    """Collects FFmpeg's stderr tail and turns -progress blocks into callbacks"""
+
+    def __init__(self, on_progress: Optional[Callable[[dict], None]] = None):
+        # Keep only the log tail (errors are at the end)
+        self.tail = deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+        self.progress = {}
+        self.on_progress = on_progress
+
+    def feed(self, line: str) -> None:
+        match = FFMPEG_PROGRESS_RE.match(line.strip())
+        if not match:
+            self.tail.append(line)
+            return
+        key, value = match.groups()
+        self.progress[key] = value
+        # "progress" closes each block of key=value lines
+        if key == "progress" and self.on_progress:
+            self.on_progress(self.progress.copy())
+
+    def text(self) -> str:
+        return "".join(self.tail)
+
+
+async def run_ffmpeg_process(args: List[str], work_dir: Path, log: FFmpegLog) -> int:
+    """Run FFmpeg as an asyncio subprocess, reading stderr on the event loop"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=work_dir,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        async for raw_line in process.stderr:
+            log.feed(raw_line.decode(errors="replace"))
+        return await process.wait()
+    finally:
+        # Don't leave an orphaned encode running if the request was cancelled
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+def run_ffmpeg_process_sync(
+    args: List[str],
+    work_dir: Path,
+    log: FFmpegLog,
+    on_start: Callable[[subprocess.Popen], None]
+) -> int:
+    """Run FFmpeg with Popen on a worker thread, reading stderr as it is produced"""
+    process = subprocess.Popen(
+        args,
+        cwd=work_dir,
+        shell=False,  # Don't use shell to avoid arg escaping issues
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        bufsize=1
+    )
+    on_start(process)
+    for line in process.stderr:
+        log.feed(line)
+    return process.wait()
+
+
+async def execute_ffmpeg_command(
+    command: str,
+    work_dir: Path,
+    on_progress: Optional[Callable[[dict], None]] = None
+) -> tuple[bool, str]:
+    """Execute FFmpeg command and return success status and output"""
     try:
-        logger.info(f"Executing FFmpeg in directory: {work_dir}")
-        logger.info(f"Command length: {len(command)} characters")
-        logger.info(f"Command: {command[:200]}..." if len(command) > 200 else f"Command: {command}")
+        logger.info("Executing FFmpeg in directory: %s", work_dir)
+        logger.info("Command length: %s characters", len(command))
+        logger.info("Command: %.200s%s", command, "..." if len(command) > 200 else "")
         
         # Parse command into arguments (POSIX mode for proper quote handling)
-        args = shlex.split(command, posix=True)
+        args = tokenize_ffmpeg_command(command)
         
-        logger.info(f"Parsed {len(args)} arguments")
+        logger.info("Parsed %s arguments", len(args))
         
         if args[0] != "ffmpeg":
             return False, "Command must start with 'ffmpeg'"
         
-        # Replace 'ffmpeg' with path to bundled executable
-        args[0] = get_ffmpeg_path()
+        # Replace 'ffmpeg' with path to bundled executable and request
+        # machine-readable progress on stderr instead of the stats line
+        args = [get_ffmpeg_path(), "-progress", "pipe:2", "-nostats", *args[1:]]
+        log = FFmpegLog(on_progress)
         
-        # Execute FFmpeg command
-        result = subprocess.run(
-            args,
-            cwd=work_dir,
-            shell=False,  # Don't use shell to avoid arg escaping issues
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+        async with FFMPEG_SEMAPHORE:
+            try:
+                # The event loop reads stderr, so no worker thread is held while the encode runs
+                returncode = await run_ffmpeg_process(args, work_dir, log)
+            except NotImplementedError:
+                # Selector event loops have no subprocess support; uvicorn uses one
+                # on Windows with --reload (start.bat, share.bat), so read from a thread
+                started = []
+                
+                def kill_started() -> None:
+                    for process in started:
+                        process.kill()
+                
+                returncode = await await_worker(
+                    asyncio.ensure_future(
+                        asyncio.to_thread(run_ffmpeg_process_sync, args, work_dir, log, started.append)
+                    ),
+                    on_cancel=kill_started
+                )
+        stderr = log.text()
         
-        logger.info(f"FFmpeg return code: {result.returncode}")
+        logger.info("FFmpeg return code: %s", returncode)
         
-        if result.returncode == 0:
+        if returncode == 0:
             logger.info("FFmpeg execution successful")
-            return True, result.stderr
+            return True, stderr
         else:
-            logger.warning(f"FFmpeg failed with stderr:\n{result.stderr}")
-            return False, result.stderr
+            logger.warning("FFmpeg failed with stderr:\n%s", stderr)
+            return False, stderr
             
     except FileNotFoundError:
         error_msg = "FFmpeg not found. Please install FFmpeg and add it to your PATH."
@@ -450,6 +1359,286 @@ def execute_ffmpeg_command_sync(command: str, work_dir: Path) -> tuple[bool, str
         return False, error_msg
 
 
+def get_output_cache_key(prompt: str, files_info: List[FileInfo], temperature: float, top_p: float) -> Optional[str]:
+    """Hash file contents, names and generation settings into an output cache key"""
+    if any(info.sha256 is None for info in files_info):
+        return None
+    digest = hashlib.sha256()
+    # Upload order is the timeline order (slideshow/concat sequence), so it is part of the key
+    for name, sha256 in ((info.name, info.sha256) for info in files_info):
+        digest.update(f"{name}\0{sha256}\0".encode())
+    digest.update(f"{prompt}\0{temperature}\0{top_p}".encode())
+    return digest.hexdigest()
+
+
+def load_cached_output(cache_key: str) -> Optional[tuple[Path, dict]]:
+    """Look up a cached video and its generation metadata"""
+    video_file = CACHE_DIR / f"{cache_key}.mp4"
+    meta_file = CACHE_DIR / f"{cache_key}.json"
+    if not (video_file.exists() and meta_file.exists()):
+        return None
+    try:
+        return video_file, json.loads(meta_file.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_output(cache_key: str, output_file: Path, command: str, full_response: str) -> None:
+    """Copy a rendered video into the cache, evicting the oldest entries beyond the limit"""
+    try:
+        tmp_file = CACHE_DIR / f"{cache_key}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(output_file, tmp_file)
+        os.replace(tmp_file, CACHE_DIR / f"{cache_key}.mp4")
+        (CACHE_DIR / f"{cache_key}.json").write_text(
+            json.dumps({"command": command, "full_response": full_response})
+        )
+        
+        cached_videos = sorted(CACHE_DIR.glob("*.mp4"), key=lambda p: p.stat().st_mtime)
+        for video_file in cached_videos[:-OUTPUT_CACHE_MAX_FILES]:
+            video_file.unlink(missing_ok=True)
+            video_file.with_suffix(".json").unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning("Failed to cache output: %s", e)
+
+
+# Newlines/tabs are invalid in HTTP header values
+HEADER_VALUE_TRANSLATION = str.maketrans({"\n": " ", "\r": None, "\t": " "})
+
+
+def build_video_response(
+    output_file: Path,
+    command: Optional[str],
+    full_response: Optional[str],
+    process_logs: List[str]
+) -> FileResponse:
+    """Return the video file with the command, AI response and logs in headers"""
+    # Clean header values (remove newlines and special chars that are invalid in HTTP headers)
+    safe_command = (command or "")[:1000].translate(HEADER_VALUE_TRANSLATION)
+    safe_response = (full_response or "")[:500].translate(HEADER_VALUE_TRANSLATION)
+    # Use a pipe separator for logs (can't use newlines in HTTP headers)
+    safe_logs = "||".join(process_logs)
+    
+    logger.info("Returning response with command length: %s", len(safe_command))
+    logger.info("Command preview: %.100s...", safe_command)
+    
+    return FileResponse(
+        output_file,
+        media_type="video/mp4",
+        filename="output.mp4",
+        headers={
+            "X-Generated-Command": safe_command[:1000],  # Limit header size
+            "X-AI-Response": safe_response[:500],
+            "X-Process-Logs": safe_logs[:2000]  # Limit to 2KB
+        }
+    )
+
+
+async def render_video(
+    prompt: str,
+    files_info: List[FileInfo],
+    session_dir: Path,
+    temperature: float,
+    top_p: float,
+    process_logs: List[str]
+) -> FileResponse:
+    """Generate and execute an FFmpeg command with retries, returning the output video"""
+    session_id = session_dir.name
+    
+    def report_ffmpeg_progress(progress: dict) -> None:
+        out_time_us = progress.get("out_time_us", "")
+        update_progress(
+            session_id,
+            frame=int(progress["frame"]) if progress.get("frame", "").isdigit() else None,
+            out_time=int(out_time_us) / 1_000_000 if out_time_us.isdigit() else None,
+            speed=progress.get("speed", "").strip() or None
+        )
+    
+    # Identical inputs and prompt: serve the previously rendered video
+    cache_key = get_output_cache_key(prompt, files_info, temperature, top_p)
+    cached = load_cached_output(cache_key) if cache_key else None
+    if cached:
+        video_file, meta = cached
+        logger.info("Serving cached output for key %.12s", cache_key)
+        process_logs.append("[SUCCESS] Served cached video for identical request")
+        finish_progress(session_id, "done")
+        return build_video_response(video_file, meta.get("command"), meta.get("full_response"), process_logs)
+    
+    # Generate FFmpeg command
+    max_retries = 3
+    retry_count = 0
+    command = None
+    full_response = None
+    failed_command = None
+    last_error = None
+    success = False
+    
+    output_file = session_dir / "output.mp4"
+    # Never delete an upload that happens to share the output's name
+    clear_output = all(info.name != output_file.name for info in files_info)
+    
+    process_logs.append("[INFO] Analyzing media files...")
+    # files_info doesn't change between retries, so the prompt's assets table is built once
+    files_table = create_files_info_table(files_info)
+    
+    while retry_count < max_retries:
+        try:
+            # Add small delay between retries to respect rate limits
+            if retry_count > 0:
+                delay = 2 * retry_count  # Progressive delay
+                logger.info("Waiting %s seconds before retry...", delay)
+                await asyncio.sleep(delay)
+            
+            logger.info("Generating command (attempt %s/%s)", retry_count + 1, max_retries)
+            update_progress(session_id, status="generating", attempt=retry_count + 1)
+            if retry_count == 0:
+                process_logs.append("[INFO] Generating FFmpeg commands...")
+            else:
+                process_logs.append(f"[INFO] Retrying command generation (attempt {retry_count + 1})...")
+                
+            candidates = generate_ffmpeg_commands(
+                prompt=prompt,
+                files_info=files_info,
+                temperature=temperature,
+                top_p=top_p,
+                previous_error=last_error,
+                previous_command=failed_command,
+                candidates=FIRST_ATTEMPT_CANDIDATES if retry_count == 0 else 1,
+                files_table=files_table
+            )
+            
+            failed_command = None
+            tried = 0
+            try:
+                # Later candidates are only awaited if the ones before them fail
+                async for generated_command, full_response in candidates:
+                    if not generated_command:
+                        continue
+                    command = apply_ffmpeg_command_hints(generated_command, files_info)
+                    logger.info("Generated command: %s", command)
+                    if tried == 0:
+                        process_logs.append("[OK] Generated FFmpeg command")
+                    else:
+                        process_logs.append("[INFO] Trying alternative command...")
+                    tried += 1
+                    
+                    # Log command for debugging
+                    logger.info("Full command length: %s characters", len(command))
+                    logger.debug("AI full response: %s", full_response)
+                    
+                    # Execute command (bounded by FFMPEG_SEMAPHORE, without blocking the loop)
+                    process_logs.append("[INFO] Processing video...")
+                    update_progress(session_id, status="rendering", frame=None, out_time=None, speed=None)
+                    # A failed run can leave a partial output.mp4; don't let it pass for the next one's result
+                    if clear_output:
+                        output_file.unlink(missing_ok=True)
+                    success, output = await execute_ffmpeg_command(command, session_dir, report_ffmpeg_progress)
+                    
+                    if success:
+                        break
+                    
+                    logger.warning("Command failed with error:\n%s", output)
+                    logger.warning("Full command was: %s", command)
+                    # The retry prompt explains why the first (preferred) candidate failed
+                    if failed_command is None:
+                        failed_command, last_error = command, output
+            finally:
+                await candidates.aclose()
+            
+            if not tried:
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to extract FFmpeg command from AI response"
+                )
+            
+            if success:
+                process_logs.append("[SUCCESS] Video generated successfully!")
+                finish_progress(session_id, "done")
+                break
+            
+            retry_count += 1
+        except Exception as gen_error:
+            # The endpoint marks the session failed once the error propagates
+            logger.error("Error in command generation: %s", gen_error)
+            raise
+    
+    # A partial file from a failed run doesn't count; only a successful run's output does
+    if not success or not output_file.exists():
+        error_msg = f"Failed to generate video after {max_retries} attempts. Last error: {last_error}"
+        logger.error(error_msg)
+        raise HTTPException(
+            status_code=500,
+            detail=error_msg
+        )
+    
+    # Only a command that actually rendered is worth replaying for the same request
+    command_cache_key = get_command_cache_key(prompt, files_info, temperature, top_p)
+    remember_command(command_cache_key, (generated_command, full_response))
+    await asyncio.to_thread(store_cached_command, command_cache_key, generated_command, full_response)
+    if cache_key:
+        await asyncio.to_thread(store_cached_output, cache_key, output_file, command, full_response)
+    
+    # Return the video file
+    return build_video_response(output_file, command, full_response, process_logs)
+
+
+async def run_render_session(
+    background_tasks: BackgroundTasks,
+    session_id: Optional[str],
+    file_count: int,
+    ingest: Callable[[Path], Awaitable[List[FileInfo]]],
+    prompt: str,
+    temperature: float,
+    top_p: float,
+    process_logs: List[str]
+) -> FileResponse:
+    """Create a session, ingest its files into it and render, cleaning up on every exit path
+    
+    Shared by /process and /process-stream, which differ only in how files arrive.
+    """
+    session_id = parse_session_id(session_id)
+    session_dir = WORK_DIR / session_id
+    session_dir.mkdir(exist_ok=True)
+    logger.info("Created session directory: %s", session_dir)
+    process_logs.append(f"[INFO] Created session: {session_id[:8]}")
+    cleanup_scheduled = False
+    
+    try:
+        process_logs.append(f"[INFO] Uploading {file_count} file(s)...")
+        files_info = await ingest(session_dir)
+        for file_info in files_info:
+            process_logs.append(f"[OK] Loaded: {file_info.name} ({file_info.type})")
+        
+        response = await render_video(
+            prompt=prompt,
+            files_info=files_info,
+            session_dir=session_dir,
+            temperature=temperature,
+            top_p=top_p,
+            process_logs=process_logs
+        )
+        # Remove session files once the video has been sent
+        background_tasks.add_task(shutil.rmtree, session_dir, ignore_errors=True)
+        cleanup_scheduled = True
+        return response
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error processing video: %s", e)
+        logger.error(traceback.format_exc())
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Error processing video: {str(e)}"
+        )
+    
+    finally:
+        # Covers ingest failures and client disconnects (CancelledError) as well
+        fail_unfinished_progress(session_id)
+        if not cleanup_scheduled:
+            # Error responses don't run background tasks; clean up off the event loop
+            await asyncio.to_thread(shutil.rmtree, session_dir, ignore_errors=True)
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -475,16 +1664,54 @@ async def health_check():
         "status": "healthy" if ffmpeg_available and groq_configured else "unhealthy",
         "ffmpeg_installed": ffmpeg_available,
         "groq_configured": groq_configured,
-        "model": GROQ_MODEL
+        "model": GROQ_MODEL,
+        "h264_encoder": detect_h264_encoder()[0]
     }
 
 
+@app.get("/progress/{session_id}")
+async def stream_progress(session_id: str):
+    """
+    Stream render progress for a session as Server-Sent Events
+    
+    Each event is the session's JSON state: status (generating, rendering,
+    done, failed), attempt, and FFmpeg's frame, out_time (seconds) and speed.
+    The stream ends once the session is done or failed.
+    """
+    session_id = normalize_session_id(session_id)
+    
+    async def event_stream():
+        last_state = None
+        waited = 0.0
+        while True:
+            state = SESSION_PROGRESS.get(session_id)
+            if state is None:
+                waited += PROGRESS_POLL_INTERVAL
+                if waited > PROGRESS_WAIT_TIMEOUT:
+                    yield f"data: {json.dumps({'status': 'unknown'})}\n\n"
+                    return
+            elif state != last_state:
+                last_state = state
+                yield f"data: {json.dumps(state)}\n\n"
+                if state.get("status") in ("done", "failed"):
+                    return
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
 @app.post("/process")
 async def process_video(
-    files: List[UploadFile] = File(...),
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = Depends(validated_upload_files),
     prompt: str = Form(...),
     temperature: float = Form(0.1),
-    top_p: float = Form(0.95)
+    top_p: float = Form(0.95),
+    session_id: Optional[str] = Form(None)
 ):
     """
     Process media files with natural language instructions
@@ -494,6 +1721,9 @@ async def process_video(
     2. Generates FFmpeg command using Gemini AI
     3. Executes the command
     4. Returns the generated video
+    
+    Pass a client-generated UUID as session_id to follow progress
+    on /progress/{session_id} while the request runs.
     """
     
     # Collect logs for frontend display
@@ -502,166 +1732,85 @@ async def process_video(
     if not check_ffmpeg_installed():
         raise HTTPException(status_code=500, detail="FFmpeg is not installed on the server")
     
-    logger.info(f"Processing request: prompt='{prompt[:50]}...', files={len(files)}, temp={temperature}, top_p={top_p}")
+    logger.info("Processing request: prompt='%.50s...', files=%s, temp=%s, top_p=%s", prompt, len(files), temperature, top_p)
     process_logs.append(f"[INFO] Processing {len(files)} file(s) with prompt: '{prompt[:50]}...'")
     
-    # Create unique session directory
-    session_id = str(uuid.uuid4())
-    session_dir = WORK_DIR / session_id
-    session_dir.mkdir(exist_ok=True)
-    logger.info(f"Created session directory: {session_dir}")
-    process_logs.append(f"[INFO] Created session: {session_id[:8]}")
+    logger.info("Saving %s uploaded files...", len(files))
+    return await run_render_session(
+        background_tasks=background_tasks,
+        session_id=session_id,
+        file_count=len(files),
+        ingest=functools.partial(ingest_upload_files, files),
+        prompt=prompt,
+        temperature=temperature,
+        top_p=top_p,
+        process_logs=process_logs
+    )
+
+
+@app.post("/process-stream")
+async def process_video_stream(request: Request, background_tasks: BackgroundTasks):
+    """
+    Process a single media file sent as a raw request body
+    
+    Streaming fast path for CLI/SDK clients. The body is the file itself
+    (Content-Type: application/octet-stream) and parameters come from headers:
+    X-Filename, X-Prompt (URL-encoded), X-Temperature, X-Top-P and an
+    optional X-Session-Id for following /progress/{session_id}.
+    """
+    
+    process_logs = []
+    
+    if not check_ffmpeg_installed():
+        raise HTTPException(status_code=500, detail="FFmpeg is not installed on the server")
+    
+    filename = unquote(request.headers.get("x-filename", ""))
+    prompt = unquote(request.headers.get("x-prompt", ""))
+    if not filename or not prompt:
+        raise HTTPException(
+            status_code=400,
+            detail="X-Filename and X-Prompt headers are required"
+        )
     
     try:
-        # Save uploaded files
-        saved_files = []
-        files_info = []
-        
-        logger.info(f"Saving {len(files)} uploaded files...")
-        process_logs.append(f"[INFO] Uploading {len(files)} file(s)...")
-        
-        for upload_file in files:
-            # Validate file extension
-            file_ext = Path(upload_file.filename).suffix.lower()
-            if file_ext not in ALLOWED_EXTENSIONS:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File type {file_ext} not allowed"
-                )
-            
-            # Save file
-            sanitized_name = sanitize_filename(upload_file.filename)
-            file_path = session_dir / sanitized_name
-            
-            logger.info(f"Saving file: {sanitized_name}")
-            
-            with open(file_path, "wb") as buffer:
-                content = await upload_file.read()
-                buffer.write(content)
-            
-            saved_files.append(file_path)
-            
-            # Get file info
-            logger.info(f"Analyzing file: {sanitized_name}")
-            file_info = get_file_info(file_path)
-            files_info.append(file_info)
-            logger.info(f"File info: {file_info}")
-            process_logs.append(f"[OK] Loaded: {sanitized_name} ({file_info.type})")
-        
-        # Generate FFmpeg command
-        max_retries = 3
-        retry_count = 0
-        command = None
-        full_response = None
-        last_error = None
-        
-        process_logs.append("[INFO] Analyzing media files...")
-        
-        while retry_count < max_retries:
-            try:
-                # Add small delay between retries to respect rate limits
-                if retry_count > 0:
-                    delay = 2 * retry_count  # Progressive delay
-                    logger.info(f"Waiting {delay} seconds before retry...")
-                    await asyncio.sleep(delay)
-                
-                logger.info(f"Generating command (attempt {retry_count + 1}/{max_retries})")
-                if retry_count == 0:
-                    process_logs.append("[INFO] Generating FFmpeg commands...")
-                else:
-                    process_logs.append(f"[INFO] Retrying command generation (attempt {retry_count + 1})...")
-                    
-                command, full_response = await generate_ffmpeg_command(
-                    prompt=prompt,
-                    files_info=files_info,
-                    temperature=temperature,
-                    top_p=top_p,
-                    previous_error=last_error,
-                    previous_command=command
-                )
-                
-                if not command:
-                    raise HTTPException(
-                        status_code=500,
-                        detail="Failed to extract FFmpeg command from AI response"
-                    )
-                
-                logger.info(f"Generated command: {command}")
-                process_logs.append("[OK] Generated FFmpeg command")
-                
-                # Log command for debugging
-                logger.info(f"Full command length: {len(command)} characters")
-                logger.debug(f"AI full response: {full_response}")
-                
-                # Execute command (run in thread pool to avoid blocking)
-                process_logs.append("[INFO] Processing video...")
-                success, output = await asyncio.to_thread(
-                    execute_ffmpeg_command_sync, command, session_dir
-                )
-                
-                if success:
-                    process_logs.append("[SUCCESS] Video generated successfully!")
-                    break
-                
-                logger.warning(f"Command failed with error:\n{output}")
-                logger.warning(f"Full command was: {command}")
-                last_error = output
-                retry_count += 1
-            except Exception as gen_error:
-                logger.error(f"Error in command generation: {str(gen_error)}")
-                raise
-        
-        # Check if output file was created
-        output_file = session_dir / "output.mp4"
-        if not output_file.exists():
-            error_msg = f"Failed to generate video after {max_retries} attempts. Last error: {last_error}"
-            logger.error(error_msg)
-            raise HTTPException(
-                status_code=500,
-                detail=error_msg
-            )
-        
-        # Return the video file
-        # Clean header values (remove newlines and special chars that are invalid in HTTP headers)
-        safe_command = (command or "").replace('\n', ' ').replace('\r', '').replace('\t', ' ')
-        safe_response = (full_response or "")[:500].replace('\n', ' ').replace('\r', '').replace('\t', ' ')
-        # Use a pipe separator for logs (can't use newlines in HTTP headers)
-        safe_logs = "||".join(process_logs)
-        
-        logger.info(f"Returning response with command length: {len(safe_command)}")
-        logger.info(f"Command preview: {safe_command[:100]}...")
+        temperature = float(request.headers.get("x-temperature", 0.1))
+        top_p = float(request.headers.get("x-top-p", 0.95))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid X-Temperature or X-Top-P header")
+    
+    validate_file_extension(filename)
+    
+    logger.info("Processing stream request: prompt='%.50s...', file=%s, temp=%s, top_p=%s", prompt, filename, temperature, top_p)
+    process_logs.append(f"[INFO] Processing 1 file(s) with prompt: '{prompt[:50]}...'")
+    
+    async def ingest(session_dir: Path) -> List[FileInfo]:
+        sanitized_name = sanitize_filename(filename)
+        file_path = session_dir / sanitized_name
         
-        return FileResponse(
-            output_file,
-            media_type="video/mp4",
-            filename="output.mp4",
-            headers={
-                "X-Generated-Command": safe_command[:1000],  # Limit header size
-                "X-AI-Response": safe_response[:500],
-                "X-Process-Logs": safe_logs[:2000]  # Limit to 2KB
-            }
-        )
+        logger.info("Streaming file: %s", sanitized_name)
+        sha256 = await write_chunks(request.stream(), file_path, filename)
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error processing video: {str(e)}")
-        logger.error(traceback.format_exc())
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Error processing video: {str(e)}"
-        )
+        file_info = await asyncio.get_running_loop().run_in_executor(PROBE_POOL, get_file_info, file_path)
+        file_info.sha256 = sha256
+        logger.info("File info: %s", file_info)
+        return [file_info]
     
-    finally:
-        # Cleanup (in production, might want to keep files for a while)
-        # Uncomment to enable cleanup:
-        # shutil.rmtree(session_dir, ignore_errors=True)
-        pass
+    return await run_render_session(
+        background_tasks=background_tasks,
+        session_id=request.headers.get("x-session-id"),
+        file_count=1,
+        ingest=ingest,
+        prompt=prompt,
+        temperature=temperature,
+        top_p=top_p,
+        process_logs=process_logs
+    )
 
 
 @app.post("/generate-command")
 async def generate_command_only(
-    files: List[UploadFile] = File(...),
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = Depends(validated_upload_files),
     prompt: str = Form(...),
     temperature: float = Form(0.1),
     top_p: float = Form(0.95)
@@ -674,21 +1823,11 @@ async def generate_command_only(
     session_id = str(uuid.uuid4())
     session_dir = WORK_DIR / session_id
     session_dir.mkdir(exist_ok=True)
+    cleanup_scheduled = False
     
     try:
         # Save and analyze files
-        files_info = []
-        
-        for upload_file in files:
-            sanitized_name = sanitize_filename(upload_file.filename)
-            file_path = session_dir / sanitized_name
-            
-            with open(file_path, "wb") as buffer:
-                content = await upload_file.read()
-                buffer.write(content)
-            
-            file_info = get_file_info(file_path)
-            files_info.append(file_info)
+        files_info = await ingest_upload_files(files, session_dir)
         
         # Generate command
         command, full_response = await generate_ffmpeg_command(
@@ -698,15 +1837,18 @@ async def generate_command_only(
             top_p=top_p
         )
         
+        # Cleanup temporary files after the response is sent
+        background_tasks.add_task(shutil.rmtree, session_dir, ignore_errors=True)
+        cleanup_scheduled = True
         return {
             "command": command,
             "full_response": full_response,
-            "files_info": [info.dict() for info in files_info]
+            "files_info": [info.model_dump() for info in files_info]
         }
         
     finally:
-        # Cleanup temporary files
-        shutil.rmtree(session_dir, ignore_errors=True)
+        if not cleanup_scheduled:
+            await asyncio.to_thread(shutil.rmtree, session_dir, ignore_errors=True)
 
 
 if FRONTEND_ASSETS_DIR.exists():